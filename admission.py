@@ -0,0 +1,71 @@
+"""昂貴 AI 路徑的准入控制：每位用戶一個 token bucket，加上全域同時執行上限。
+
+超過限制時立即拒絕而不排隊，讓呼叫端馬上回覆「請稍後再試」。
+只在事件迴圈執行緒上使用，因此不需要加鎖。
+"""
+import time
+from contextlib import contextmanager
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AdmissionController:
+    def __init__(self, rate_per_minute, burst, max_concurrent, max_tracked_users=10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_tracked_users = max_tracked_users
+        self.in_flight = 0
+        self.buckets = {}
+
+    def try_acquire(self, user_id):
+        if self.in_flight >= self.max_concurrent:
+            print(f"[DEBUG] 全域 AI 同時執行數已滿，拒絕 {user_id}")
+            return False
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= self.max_tracked_users:
+                self._prune(now)
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst, now)
+        if not bucket.try_take(now):
+            print(f"[DEBUG] 用戶 {user_id} 超過 AI 使用頻率，拒絕")
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+    @contextmanager
+    def admit(self, user_id):
+        admitted = self.try_acquire(user_id)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release()
+
+    def _prune(self, now):
+        # 已經補滿的 bucket 與新建的一樣，可以直接丟掉
+        for user_id, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[user_id]
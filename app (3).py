@@ -1,6 +1,6 @@
 import os
 import sqlite3
-import requests
+import asyncio
 import tempfile
 import logging
 from io import BytesIO
@@ -10,12 +10,9 @@ from PIL import Image
 
 from linebot.v3.webhook import WebhookParser, WebhookHandler
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, ImageMessageContent
-from linebot.v3.messaging import MessagingApi, Configuration, ApiClient, MessagingApiBlob
+from linebot.v3.messaging import Configuration
 from linebot.v3.messaging.models import (
-    TextMessage, ReplyMessageRequest, PushMessageRequest,
-    FlexMessage, FlexBubble, FlexBox, FlexText, FlexButton, URIAction,
-    QuickReply, QuickReplyItem, LocationAction, ImageMessage, DatetimePickerAction,
-    MessageAction
+    TextMessage, QuickReply, QuickReplyItem, MessageAction
 )
 from linebot.v3.exceptions import InvalidSignatureError
 
@@ -25,6 +22,20 @@ import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 import pytz
 
+from side_effects import init_side_effects_table, get_cached_side_effects, generate_and_store_side_effects_async
+from admission import AdmissionController
+from drug_matcher import DrugMatcher, init_drug_change_log
+from async_core import AsyncIOCore
+from reply_templates import (
+    CachedReplyMessageRequest, CachedPushMessageRequest, EDIT_FIELD_QUICK_REPLY,
+    ASK_MEDICINE_MESSAGE, ASK_START_DATE_MESSAGE, ASK_END_DATE_MESSAGE, ASK_TIMES_MESSAGE,
+    INVALID_TIMES_MESSAGE, NO_REMINDERS_MESSAGE, REMINDER_NOT_FOUND_MESSAGE,
+    EDIT_START_DATE_MESSAGE, EDIT_END_DATE_MESSAGE, EDIT_TIMES_MESSAGE, EDIT_DONE_MESSAGE,
+    EDIT_FIELD_MENU_MESSAGE, EDIT_FIELD_CONTINUE_MESSAGE, ASK_IMAGE_MESSAGE,
+    ASK_LOCATION_MESSAGE, NO_PHARMACY_MESSAGE, BUSY_TEXT, BUSY_MESSAGE, pharmacy_bubble, carousel_message,
+    drug_suggestion_quick_reply
+)
+
 CHANNEL_SECRET = os.environ.get("YOUR_CHANNEL_SECRET")
 CHANNEL_ACCESS_TOKEN = os.environ.get("YOUR_CHANNEL_ACCESS_TOKEN")
 GOOGLE_MAP_API_KEY = os.environ.get("GOOGLE_MAP_API_KEY")
@@ -54,6 +65,14 @@ os.makedirs(static_tmp_path, exist_ok=True)
 configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
 parser = WebhookParser(CHANNEL_SECRET)
 handler = WebhookHandler(CHANNEL_SECRET)
+# LINE、Maps、Gemini 的對外呼叫都在這個事件迴圈上執行
+io_core = AsyncIOCore(configuration)
+# AI 問答、藥品副作用與圖片辨識共用：每位用戶的使用頻率與全域同時呼叫 Gemini 的上限
+ai_admission = AdmissionController(
+    rate_per_minute=float(os.environ.get("AI_RATE_PER_MINUTE", "6")),
+    burst=int(os.environ.get("AI_BURST", "3")),
+    max_concurrent=int(os.environ.get("AI_MAX_CONCURRENT", "32")),
+)
 
 genai.configure(api_key=GOOGLE_API_KEY)
 chat = genai.GenerativeModel(model_name="gemini-1.5-flash")
@@ -96,6 +115,101 @@ def init_reminders_table():
     conn.commit()
     conn.close()
 init_reminders_table()
+init_side_effects_table(DB_PATH)
+init_drug_change_log(DB_PATH)
+
+# 藥名查不到時先用記憶體內的容錯比對給建議，索引由排程在背景建立與更新
+drug_matcher = DrugMatcher()
+
+# 推播時間晚於排定時間超過此秒數即視為延遲送達
+LATE_THRESHOLD_SECONDS = 30
+# 記錄在 PRAGMA user_version，表示彙總表已建立且舊紀錄已補齊
+ADHERENCE_SCHEMA_VERSION = 1
+
+def init_adherence_tables():
+    conn = sqlite3.connect(DB_PATH)
+    # sqlite3 模組不會替 DDL 開交易，這裡自己控制，建表、補齊與版本號一起成功或一起回復
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    # WAL 模式讓統計查詢讀取時不會擋住排程寫入 reminders_log（不能在交易內切換）
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # 先取得寫入鎖，多個行程同時啟動時依序執行，後到的會看到版本號已更新而略過
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] < ADHERENCE_SCHEMA_VERSION:
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_log_lookup ON reminders_log (reminder_id, date, time)")
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS adherence_daily_user (
+                user_id TEXT NOT NULL,
+                date TEXT NOT NULL,
+                sent INTEGER NOT NULL DEFAULT 0,
+                late INTEGER NOT NULL DEFAULT 0,
+                delay_seconds INTEGER NOT NULL DEFAULT 0,
+                active_reminders INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, date)
+            );
+            """)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS adherence_daily_medicine (
+                user_id TEXT NOT NULL,
+                medicine TEXT NOT NULL,
+                date TEXT NOT NULL,
+                sent INTEGER NOT NULL DEFAULT 0,
+                late INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, medicine, date)
+            );
+            """)
+            # 由既有的 reminders_log 補齊，舊紀錄沒有送達時間，延遲一律記為 0；
+            # 已有彙總的日期不覆蓋，先前版本已建好彙總表的資料庫再跑一次也不會重複計算
+            cursor.execute("""
+            INSERT OR IGNORE INTO adherence_daily_user (user_id, date, sent)
+            SELECT r.user_id, l.date, COUNT(*)
+            FROM reminders_log l JOIN reminders r ON r.id = l.reminder_id
+            GROUP BY r.user_id, l.date
+            """)
+            cursor.execute("""
+            INSERT OR IGNORE INTO adherence_daily_medicine (user_id, medicine, date, sent)
+            SELECT r.user_id, r.medicine, l.date, COUNT(*)
+            FROM reminders_log l JOIN reminders r ON r.id = l.reminder_id
+            GROUP BY r.user_id, r.medicine, l.date
+            """)
+            cursor.execute(f"PRAGMA user_version = {ADHERENCE_SCHEMA_VERSION}")
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+init_adherence_tables()
+
+def record_reminder_sent(cursor, user_id, medicine, date, delay_seconds):
+    # 與 reminders_log 寫在同一個交易，彙總表與明細不會不一致
+    late = 1 if delay_seconds > LATE_THRESHOLD_SECONDS else 0
+    cursor.execute("""
+    INSERT INTO adherence_daily_user (user_id, date, sent, late, delay_seconds) VALUES (?, ?, 1, ?, ?)
+    ON CONFLICT (user_id, date) DO UPDATE SET
+        sent = sent + 1, late = late + excluded.late, delay_seconds = delay_seconds + excluded.delay_seconds
+    """, (user_id, date, late, delay_seconds))
+    cursor.execute("""
+    INSERT INTO adherence_daily_medicine (user_id, medicine, date, sent, late) VALUES (?, ?, ?, 1, ?)
+    ON CONFLICT (user_id, medicine, date) DO UPDATE SET
+        sent = sent + 1, late = late + excluded.late
+    """, (user_id, medicine, date, late))
+
+def refresh_active_reminders_rollup():
+    today = datetime.datetime.now(pytz.timezone('Asia/Taipei')).strftime("%Y-%m-%d")
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    # 先歸零再重算，提醒都已到期或被刪除的用戶才不會留著舊的數字；兩個語句在同一個交易
+    cursor.execute("UPDATE adherence_daily_user SET active_reminders = 0 WHERE date = ?", (today,))
+    cursor.execute("""
+    INSERT INTO adherence_daily_user (user_id, date, active_reminders)
+    SELECT user_id, ?, COUNT(*) FROM reminders WHERE start_date <= ? AND end_date >= ? GROUP BY user_id
+    ON CONFLICT (user_id, date) DO UPDATE SET active_reminders = excluded.active_reminders
+    """, (today, today, today))
+    conn.commit()
+    conn.close()
 
 def add_reminder(user_id, medicine, start_date, end_date, times):
     print("[DEBUG] add_reminder 被呼叫")
@@ -112,6 +226,104 @@ def add_reminder(user_id, medicine, start_date, end_date, times):
     conn.close()
     print("[DEBUG] ✅ 寫入 reminders 成功")
 
+# ====== 事件處理用的同步 I/O ======
+# sqlite 查詢與圖片存檔都會阻塞，事件迴圈只有一個，所以都經由 asyncio.to_thread 在 thread pool 執行
+def get_user_medicines(user_id):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT medicine FROM reminders WHERE user_id=?", (user_id,))
+    medicines = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return medicines
+
+def get_latest_reminder(user_id, medicine):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT id, start_date, end_date, times FROM reminders WHERE user_id=? AND medicine=? ORDER BY id DESC LIMIT 1",
+        (user_id, medicine)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return row
+
+REMINDER_EDITABLE_COLUMNS = ("start_date", "end_date", "times")
+
+def update_reminder(reminder_id, column, value):
+    if column not in REMINDER_EDITABLE_COLUMNS:
+        raise ValueError(f"不可修改的欄位：{column}")
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(f"UPDATE reminders SET {column}=? WHERE id=?", (value, reminder_id))
+    conn.commit()
+    conn.close()
+
+def find_drug(medicine_name, exact=False):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    if exact:
+        query = """
+            SELECT DISTINCT 中文品名, 英文品名, 適應症
+            FROM drugs
+            WHERE LOWER(中文品名) = ? OR LOWER(英文品名) = ?
+            LIMIT 1
+        """
+        params = (medicine_name, medicine_name)
+    else:
+        query = """
+        SELECT DISTINCT 中文品名, 英文品名, 適應症
+        FROM drugs
+        WHERE 中文品名 LIKE ? OR 英文品名 LIKE ?
+        LIMIT 1
+        """
+        like_param = f'%{medicine_name}%'
+        params = (like_param, like_param)
+    cursor.execute(query, params)
+    row = cursor.fetchone()
+    conn.close()
+    return row
+
+def save_image(content):
+    with tempfile.NamedTemporaryFile(dir=static_tmp_path, suffix=".jpg", delete=False) as tf:
+        tf.write(content)
+    image = Image.open(tf.name)
+    # Image.open 只讀檔頭，這裡先解碼完，避免之後在事件迴圈上才讀檔
+    image.load()
+    return image
+
+# LINE 每次推播最多 5 則訊息，每則文字最多 5000 字
+MAX_MESSAGES_PER_PUSH = 5
+MAX_TEXT_LENGTH = 5000
+
+def reminder_messages(medicines):
+    if len(medicines) == 1:
+        return [TextMessage(text=f"⏰ 用藥提醒：該服用「{medicines[0]}」囉！")]
+    texts = []
+    text = "⏰ 用藥提醒：該服用以下藥品囉！"
+    for medicine in medicines:
+        line = f"\n- {medicine}"
+        if len(text) + len(line) > MAX_TEXT_LENGTH:
+            texts.append(text)
+            text = "⏰ 用藥提醒（續）："
+        text += line
+    texts.append(text)
+    return [TextMessage(text=t) for t in texts]
+
+async def push_reminder_groups(groups):
+    async def push_group(user_id, medicines):
+        messages = reminder_messages(medicines)
+        for i in range(0, len(messages), MAX_MESSAGES_PER_PUSH):
+            await io_core.push(
+                CachedPushMessageRequest(to=user_id, messages=messages[i:i + MAX_MESSAGES_PER_PUSH])
+            )
+
+    # 不同用戶的推播同時送出，單一用戶失敗不影響其他人
+    results = await asyncio.gather(
+        *(push_group(user_id, [medicine for _, medicine in reminders]) for (user_id, _), reminders in groups.items()),
+        return_exceptions=True
+    )
+    return dict(zip(groups, results))
+
 def check_and_send_reminders():
     tz = pytz.timezone('Asia/Taipei')
     now = datetime.datetime.now(tz)
@@ -121,28 +333,47 @@ def check_and_send_reminders():
     cursor = conn.cursor()
     cursor.execute("SELECT id, user_id, medicine, start_date, end_date, times FROM reminders")
     rows = cursor.fetchall()
+    # 同一位用戶同一分鐘到期的藥品合併成一次推播，節省推播額度與 API 呼叫
+    groups = {}
     for rid, user_id, medicine, start_date, end_date, times_json in rows:
         if start_date <= today <= end_date:
             times = json.loads(times_json)
             for t in times:
+                if now_time != t:
+                    continue
                 cursor.execute("SELECT COUNT(*) FROM reminders_log WHERE reminder_id=? AND date=? AND time=?", (rid, today, t))
-                if now_time == t and cursor.fetchone()[0] == 0:
-                    print(f"[DEBUG] 發送提醒給 {user_id}：{medicine} @ {t}")
-                    with ApiClient(configuration) as api_client:
-                        messaging_api = MessagingApi(api_client)
-                        messaging_api.push_message(
-                            push_message_request=PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text=f"⏰ 用藥提醒：該服用「{medicine}」囉！")]
-                            )
-                        )
+                if cursor.fetchone()[0] == 0:
+                    groups.setdefault((user_id, t), []).append((rid, medicine))
+    if groups:
+        results = io_core.run(push_reminder_groups(groups))
+        # 推播完成後才計算延遲：排定時間到送達之間，包含輪詢間隔與推播本身花的時間
+        sent_at = datetime.datetime.now(tz)
+        for (user_id, t), reminders in groups.items():
+            error = results[(user_id, t)]
+            if error is not None:
+                # 沒寫入 reminders_log，下一次檢查（同一分鐘內）會重送
+                logging.error(f"推播提醒給 {user_id} 失敗", exc_info=error)
+                continue
+            scheduled_at = tz.localize(datetime.datetime.strptime(f"{today} {t}", "%Y-%m-%d %H:%M"))
+            delay_seconds = max(0, int((sent_at - scheduled_at).total_seconds()))
+            print(f"[DEBUG] 發送提醒給 {user_id}：{[medicine for _, medicine in reminders]} @ {t}")
+            # 同一次推播的每筆提醒一起寫入，不會只記錄到一部分
+            try:
+                for rid, medicine in reminders:
                     cursor.execute("INSERT INTO reminders_log (reminder_id, date, time) VALUES (?, ?, ?)", (rid, today, t))
-    conn.commit()
+                    record_reminder_sent(cursor, user_id, medicine, today, delay_seconds)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logging.exception(f"寫入 {user_id} 的提醒紀錄失敗")
     conn.close()
 
 if not hasattr(app, "reminder_scheduler_started"):
     scheduler = BackgroundScheduler()
     scheduler.add_job(check_and_send_reminders, 'interval', seconds=20)
+    scheduler.add_job(refresh_active_reminders_rollup, 'interval', minutes=10, next_run_time=datetime.datetime.now())
+    scheduler.add_job(drug_matcher.load, args=[DB_PATH])
+    scheduler.add_job(drug_matcher.refresh, 'interval', minutes=1, args=[DB_PATH])
     scheduler.start()
     app.reminder_scheduler_started = True
 
@@ -164,670 +395,608 @@ def show_reminders():
     print("[DEBUG] /show_reminders 查詢結果：", rows)
     return {"reminders": rows}
 
-@app.route("/callback", methods=["POST"])
-def callback():
-    signature = request.headers.get("X-Line-Signature", "")
-    body = request.get_data(as_text=True)
-    print(f"[DEBUG] 收到 callback 請求，body={body}")
-
+@app.route("/adherence_stats")
+def adherence_stats():
+    # 只讀每日彙總表，成本與天數成正比，不會掃描 reminders_log
+    user_id = request.args.get("user_id")
+    days = min(max(request.args.get("days", 30, type=int), 1), 366)
+    since = (datetime.datetime.now(pytz.timezone('Asia/Taipei')) - datetime.timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    if user_id:
+        cursor.execute(
+            "SELECT date, sent, late, delay_seconds, active_reminders FROM adherence_daily_user "
+            "WHERE user_id=? AND date>=? ORDER BY date",
+            (user_id, since)
+        )
+    else:
+        cursor.execute(
+            "SELECT date, SUM(sent), SUM(late), SUM(delay_seconds), SUM(active_reminders) FROM adherence_daily_user "
+            "WHERE date>=? GROUP BY date ORDER BY date",
+            (since,)
+        )
+    daily = [
+        {
+            "date": date,
+            "sent": sent,
+            "late": late,
+            "avg_delay_seconds": round(delay / sent, 1) if sent else None,
+            "active_reminders": active,
+        }
+        for date, sent, late, delay, active in cursor.fetchall()
+    ]
+    medicines = []
+    if user_id:
+        cursor.execute(
+            "SELECT medicine, SUM(sent), SUM(late), COUNT(*) FROM adherence_daily_medicine "
+            "WHERE user_id=? AND date>=? GROUP BY medicine ORDER BY medicine",
+            (user_id, since)
+        )
+        medicines = [
+            {"medicine": medicine, "sent": sent, "late": late, "days_sent": days_sent}
+            for medicine, sent, late, days_sent in cursor.fetchall()
+        ]
+    conn.close()
+    return {"user_id": user_id, "since": since, "daily": daily, "medicines": medicines}
+
+async def lookup_side_effects(user_id, zh_name, en_name):
+    # 預先產生的副作用只是查資料庫，不受限流；需要即時呼叫 Gemini 時才檢查
+    side_effects = await asyncio.to_thread(get_cached_side_effects, DB_PATH, zh_name, en_name)
+    if side_effects is not None:
+        print(f"[DEBUG] 副作用使用預先產生結果：{zh_name}")
+        return side_effects
+    with ai_admission.admit(user_id) as admitted:
+        if not admitted:
+            return BUSY_TEXT
+        return await generate_and_store_side_effects_async(DB_PATH, chat, zh_name, en_name)
+
+async def fetch_pharmacy_bubble(place, user_lat, user_lng):
+    place_id = place['place_id']
+    name = place.get('name', '藥局名稱未知')
+    address = place.get('vicinity', '地址不詳')
+    location = place['geometry']['location']
+    dest_lat, dest_lng = location['lat'], location['lng']
+
+    # 取得電話
+    details_url = (
+        f"https://maps.googleapis.com/maps/api/place/details/json?"
+        f"place_id={place_id}&fields=name,formatted_phone_number&key={GOOGLE_MAP_API_KEY}"
+    )
+    # 取得距離
+    dist_url = (
+        f"https://maps.googleapis.com/maps/api/distancematrix/json?"
+        f"origins={user_lat},{user_lng}&destinations={dest_lat},{dest_lng}&key={GOOGLE_MAP_API_KEY}"
+    )
+    details_res, dist_res = await asyncio.gather(io_core.get_json(details_url), io_core.get_json(dist_url))
+    phone = details_res.get('result', {}).get('formatted_phone_number', '電話不詳')
+    distance = dist_res['rows'][0]['elements'][0]['distance']['text']
+
+    map_url = f"https://www.google.com/maps/search/?api=1&query={dest_lat},{dest_lng}"
+
+    return pharmacy_bubble(name, address, phone, distance, map_url)
+
+# 每個對話來源一把鎖：同一用戶的事件依序處理，不同用戶之間平行
+# 值為 [鎖, 正在使用或等待的批次數]，沒有人使用時就移除，避免字典無限成長
+user_locks = {}
+
+def event_order_key(event):
+    source = event.source
+    for attr in ("user_id", "group_id", "room_id"):
+        key = getattr(source, attr, None)
+        if key:
+            return key
+    # 沒有來源 ID 的事件彼此沒有順序關係
+    return getattr(event, "webhook_event_id", None) or id(event)
+
+async def handle_events(events):
+    by_source = {}
+    for event in events:
+        by_source.setdefault(event_order_key(event), []).append(event)
+    # 整批的處理時間約等於最慢的那位用戶
+    await asyncio.gather(*(handle_source_events(key, source_events) for key, source_events in by_source.items()))
+
+async def handle_source_events(key, events):
+    entry = user_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
     try:
-        events = parser.parse(body, signature)
-    except InvalidSignatureError:
-        print("[DEBUG] InvalidSignatureError")
-        abort(400)
-    except Exception as e:
-        print("[DEBUG] Webhook parse error:", e)
-        abort(400)
-
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        blob_api = MessagingApiBlob(api_client)
-
-        for event in events:
-            print(f"[DEBUG] event.type={event.type}, event={event}")
-            # ====== 用藥提醒對話流程 ======
-            if event.type == "message" and event.message.type == "text":
-                user_id = event.source.user_id
-                user_input = event.message.text.strip()
-                print(f"[DEBUG] user_input: {user_input}, user_states: {user_states.get(user_id)}")
-                # 修改用藥提醒選單
-                if user_input == "修改用藥提醒":
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT DISTINCT medicine FROM reminders WHERE user_id=?", (user_id,))
-                    medicines = [row[0] for row in cursor.fetchall()]
-                    conn.close()
-                    if not medicines:
-                        reply_text = "你還沒有設定過任何藥物提醒。"
-                        reply_request = ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)]
-                        )
-                        messaging_api.reply_message(reply_message_request=reply_request)
-                        return "OK"
-                    quick_reply = QuickReply(
-                        items=[QuickReplyItem(action=MessageAction(label=med, text=med)) for med in medicines]
+        # asyncio.Lock 依先來後到喚醒，跨 webhook 請求也能保持同一用戶的事件順序
+        async with entry[0]:
+            for event in events:
+                try:
+                    await handle_event(event)
+                except Exception:
+                    logging.exception("處理事件發生錯誤")
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            user_locks.pop(key, None)
+
+async def handle_event(event):
+    messaging_api = io_core.messaging_api
+    blob_api = io_core.blob_api
+
+    print(f"[DEBUG] event.type={event.type}, event={event}")
+    # ====== 用藥提醒對話流程 ======
+    if event.type == "message" and event.message.type == "text":
+        user_id = event.source.user_id
+        user_input = event.message.text.strip()
+        print(f"[DEBUG] user_input: {user_input}, user_states: {user_states.get(user_id)}")
+        # 修改用藥提醒選單
+        if user_input == "修改用藥提醒":
+            medicines = await asyncio.to_thread(get_user_medicines, user_id)
+            if not medicines:
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[NO_REMINDERS_MESSAGE]
+                )
+                await messaging_api.reply_message(reply_message_request=reply_request)
+                return
+            quick_reply = QuickReply(
+                items=[QuickReplyItem(action=MessageAction(label=med, text=med)) for med in medicines]
+            )
+            reply_text = "請選擇你要修改的藥品："
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            user_states[user_id] = {'step': 'edit_medicine'}
+            return
+        elif user_input == "用藥提醒":
+            user_states[user_id] = {'step': 'ask_medicine'}
+            print(f"[DEBUG] 進入 ask_medicine, user_id={user_id}")
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[ASK_MEDICINE_MESSAGE]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            return
+        elif user_id in user_states:
+            state = user_states[user_id]
+            print(f"[DEBUG] user_states[{user_id}] = {state}")
+            if state.get('step') == 'ask_medicine':
+                state['medicine'] = user_input
+                state['step'] = 'ask_start'
+                print(f"[DEBUG] 進入 ask_start, user_id={user_id}, medicine={user_input}")
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[ASK_START_DATE_MESSAGE]
+                )
+                await messaging_api.reply_message(reply_message_request=reply_request)
+                return
+            elif state.get('step') == 'ask_times':
+                print(f"[DEBUG] 進入 ask_times, user_id={user_id}, state={state}")
+                times = [t.strip() for t in user_input.split(",") if t.strip()]
+                # 檢查每個時間格式是否為 HH:MM
+                import re
+                valid = True
+                for t in times:
+                    if not re.match(r"^(?:[01]\d|2[0-3]):[0-5]\d$", t):
+                        valid = False
+                        break
+                if not times or not valid:
+                    reply_request = CachedReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[INVALID_TIMES_MESSAGE]
                     )
-                    reply_text = "請選擇你要修改的藥品："
-                    reply_request = ReplyMessageRequest(
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    return
+                # 時間格式正確才繼續
+                await asyncio.to_thread(add_reminder, user_id, state['medicine'], state['start_date'], state['end_date'], times)
+                reply_text = f"已設定提醒：{state['medicine']}\n從 {state['start_date']} 到 {state['end_date']}\n每天：{', '.join(times)}"
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text)]
+                )
+                await messaging_api.reply_message(reply_message_request=reply_request)
+                user_states.pop(user_id, None)
+                print(f"[DEBUG] 完成提醒流程，user_states 移除 {user_id}")
+                return
+            # ====== 修改用藥提醒流程 ======
+            elif state.get('step') == 'edit_medicine':
+                selected_medicine = user_input
+                row = await asyncio.to_thread(get_latest_reminder, user_id, selected_medicine)
+                if not row:
+                    reply_request = CachedReplyMessageRequest(
                         reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
+                        messages=[REMINDER_NOT_FOUND_MESSAGE]
                     )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    user_states[user_id] = {'step': 'edit_medicine'}
-                    return "OK"
-                elif user_input == "用藥提醒":
-                    user_states[user_id] = {'step': 'ask_medicine'}
-                    print(f"[DEBUG] 進入 ask_medicine, user_id={user_id}")
-                    reply_text = "請輸入要提醒的藥品名稱："
-                    reply_request = ReplyMessageRequest(
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    user_states.pop(user_id, None)
+                    return
+                reminder_id, start_date, end_date, times_json = row
+                times = ','.join(json.loads(times_json))
+                reply_text = (
+                    f"你目前的提醒設定：\n"
+                    f"藥品：{selected_medicine}\n"
+                    f"開始：{start_date}\n"
+                    f"結束：{end_date}\n"
+                    f"時間：{times}\n"
+                    "請選擇要修改的欄位，或輸入 完成 結束："
+                )
+                state['step'] = 'edit_field'
+                state['reminder_id'] = reminder_id
+                state['medicine'] = selected_medicine
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text, quick_reply=EDIT_FIELD_QUICK_REPLY)]
+                )
+                await messaging_api.reply_message(reply_message_request=reply_request)
+                return
+            elif state.get('step') == 'edit_field':
+                field = user_input.strip()
+                if field == "開始日期":
+                    state['step'] = 'edit_start_date'
+                    reply_request = CachedReplyMessageRequest(
                         reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)]
+                        messages=[EDIT_START_DATE_MESSAGE]
                     )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    return "OK"
-                elif user_id in user_states:
-                    state = user_states[user_id]
-                    print(f"[DEBUG] user_states[{user_id}] = {state}")
-                    if state.get('step') == 'ask_medicine':
-                        state['medicine'] = user_input
-                        state['step'] = 'ask_start'
-                        print(f"[DEBUG] 進入 ask_start, user_id={user_id}, medicine={user_input}")
-                        quick_reply = QuickReply(
-                            items=[
-                                QuickReplyItem(
-                                    action=DatetimePickerAction(
-                                        label="選擇開始日期",
-                                        data="start_date",
-                                        mode="date"
-                                    )
-                                )
-                            ]
-                        )
-                        reply_text = "請選擇提醒開始日期："
-                        reply_request = ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
-                        )
-                        messaging_api.reply_message(reply_message_request=reply_request)
-                        return "OK"
-                    elif state.get('step') == 'ask_times':
-                        print(f"[DEBUG] 進入 ask_times, user_id={user_id}, state={state}")
-                        times = [t.strip() for t in user_input.split(",") if t.strip()]
-                        # 檢查每個時間格式是否為 HH:MM
-                        import re
-                        valid = True
-                        for t in times:
-                            if not re.match(r"^(?:[01]\d|2[0-3]):[0-5]\d$", t):
-                                valid = False
-                                break
-                        if not times or not valid:
-                            reply_text = "時間格式錯誤，請重新輸入（24小時制，如 08:00,12:00,18:00）："
-                            reply_request = ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=reply_text)]
-                            )
-                            messaging_api.reply_message(reply_message_request=reply_request)
-                            return "OK"
-                        # 時間格式正確才繼續
-                        add_reminder(user_id, state['medicine'], state['start_date'], state['end_date'], times)
-                        reply_text = f"已設定提醒：{state['medicine']}\n從 {state['start_date']} 到 {state['end_date']}\n每天：{', '.join(times)}"
-                        reply_request = ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)]
-                        )
-                        messaging_api.reply_message(reply_message_request=reply_request)
-                        user_states.pop(user_id, None)
-                        print(f"[DEBUG] 完成提醒流程，user_states 移除 {user_id}")
-                        return "OK"
-                    # ====== 修改用藥提醒流程 ======
-                    elif state.get('step') == 'edit_medicine':
-                        selected_medicine = user_input
-                        conn = sqlite3.connect(DB_PATH)
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            "SELECT id, start_date, end_date, times FROM reminders WHERE user_id=? AND medicine=? ORDER BY id DESC LIMIT 1",
-                            (user_id, selected_medicine)
-                        )
-                        row = cursor.fetchone()
-                        conn.close()
-                        if not row:
-                            reply_text = "查無此藥品提醒資料。"
-                            reply_request = ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=reply_text)]
-                            )
-                            messaging_api.reply_message(reply_message_request=reply_request)
-                            user_states.pop(user_id, None)
-                            return "OK"
-                        reminder_id, start_date, end_date, times_json = row
-                        times = ','.join(json.loads(times_json))
-                        reply_text = (
-                            f"你目前的提醒設定：\n"
-                            f"藥品：{selected_medicine}\n"
-                            f"開始：{start_date}\n"
-                            f"結束：{end_date}\n"
-                            f"時間：{times}\n"
-                            "請選擇要修改的欄位，或輸入 完成 結束："
-                        )
-                        quick_reply = QuickReply(
-                            items=[
-                                QuickReplyItem(action=MessageAction(label="開始日期", text="開始日期")),
-                                QuickReplyItem(action=MessageAction(label="結束日期", text="結束日期")),
-                                QuickReplyItem(action=MessageAction(label="提醒時間", text="提醒時間")),
-                                QuickReplyItem(action=MessageAction(label="完成", text="完成")),
-                            ]
-                        )
-                        state['step'] = 'edit_field'
-                        state['reminder_id'] = reminder_id
-                        state['medicine'] = selected_medicine
-                        reply_request = ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
-                        )
-                        messaging_api.reply_message(reply_message_request=reply_request)
-                        return "OK"
-                    elif state.get('step') == 'edit_field':
-                        field = user_input.strip()
-                        if field == "開始日期":
-                            state['step'] = 'edit_start_date'
-                            quick_reply = QuickReply(
-                                items=[
-                                    QuickReplyItem(
-                                        action=DatetimePickerAction(
-                                            label="選擇開始日期",
-                                            data="edit_start_date",
-                                            mode="date"
-                                        )
-                                    )
-                                ]
-                            )
-                            reply_text = "請選擇新的開始日期："
-                            reply_request = ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
-                            )
-                            messaging_api.reply_message(reply_message_request=reply_request)
-                            return "OK"
-                        elif field == "結束日期":
-                            state['step'] = 'edit_end_date'
-                            quick_reply = QuickReply(
-                                items=[
-                                    QuickReplyItem(
-                                        action=DatetimePickerAction(
-                                            label="選擇結束日期",
-                                            data="edit_end_date",
-                                            mode="date"
-                                        )
-                                    )
-                                ]
-                            )
-                            reply_text = "請選擇新的結束日期："
-                            reply_request = ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
-                            )
-                            messaging_api.reply_message(reply_message_request=reply_request)
-                            return "OK"
-                        elif field == "提醒時間":
-                            state['step'] = 'edit_times'
-                            reply_text = "請輸入新的提醒時間（24小時制，用逗號分隔）："
-                            reply_request = ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=reply_text)]
-                            )
-                            messaging_api.reply_message(reply_message_request=reply_request)
-                            return "OK"
-                        elif field.lower() == "完成":
-                            reply_text = "已結束修改。"
-                            user_states.pop(user_id, None)
-                            reply_request = ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=reply_text)]
-                            )
-                            messaging_api.reply_message(reply_message_request=reply_request)
-                            return "OK"
-                        else:
-                            # 再次顯示選單
-                            quick_reply = QuickReply(
-                                items=[
-                                    QuickReplyItem(action=MessageAction(label="開始日期", text="開始日期")),
-                                    QuickReplyItem(action=MessageAction(label="結束日期", text="結束日期")),
-                                    QuickReplyItem(action=MessageAction(label="提醒時間", text="提醒時間")),
-                                    QuickReplyItem(action=MessageAction(label="完成", text="完成")),
-                                ]
-                            )
-                            reply_text = "請選擇要修改的欄位，或輸入 完成 結束："
-                            reply_request = ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
-                            )
-                            messaging_api.reply_message(reply_message_request=reply_request)
-                            return "OK"
-                    elif state.get('step') == 'edit_times':
-                        import re
-                        times = [t.strip() for t in user_input.split(",") if t.strip()]
-                        valid = all(re.match(r"^(?:[01]\d|2[0-3]):[0-5]\d$", t) for t in times)
-                        if not times or not valid:
-                            reply_text = "時間格式錯誤，請重新輸入（24小時制，如 08:00,12:00,18:00）："
-                            reply_request = ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=reply_text)]
-                            )
-                            messaging_api.reply_message(reply_message_request=reply_request)
-                            return "OK"
-                        conn = sqlite3.connect(DB_PATH)
-                        cursor = conn.cursor()
-                        cursor.execute("UPDATE reminders SET times=? WHERE id=?", (json.dumps(times), state['reminder_id']))
-                        conn.commit()
-                        conn.close()
-                        reply_text = "提醒時間已更新！"
-                        # 修改完繼續顯示選單
-                        quick_reply = QuickReply(
-                            items=[
-                                QuickReplyItem(action=MessageAction(label="開始日期", text="開始日期")),
-                                QuickReplyItem(action=MessageAction(label="結束日期", text="結束日期")),
-                                QuickReplyItem(action=MessageAction(label="提醒時間", text="提醒時間")),
-                                QuickReplyItem(action=MessageAction(label="完成", text="完成")),
-                            ]
-                        )
-                        reply_text += "\n請選擇要繼續修改的欄位，或輸入 完成 結束："
-                        reply_request = ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
-                        )
-                        messaging_api.reply_message(reply_message_request=reply_request)
-                        state['step'] = 'edit_field'
-                        return "OK"
-
-                # ====== 其他功能區塊（查詢藥品、AI、藥局、圖片） ======
-                user_input = event.message.text.strip()
-                print("[DEBUG] 進入原有功能區塊，收到訊息：", user_input)
-
-                # AI 問答
-                if user_input.startswith("AI "):
-                    prompt = "你是一個中文的AI助手，請用繁體中文回答。\n" + user_input[3:].strip()
-                    try:
-                        response = chat.generate_content(prompt)
-                        reply_text = response.text
-                    except Exception as e:
-                        logging.exception("AI 問答發生錯誤")
-                        reply_text = "⚠️ AI 回答失敗，請稍後再試"
-                        reply_request = ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)]
-                        )
-                        messaging_api.reply_message(reply_message_request=reply_request)
-                        return "OK"
-
-                # 查詢藥品
-                elif user_input == "查詢藥品":
-                    try:
-                        # 這裡應該要有 medicine_name 的來源，通常是 user_states 或請用戶再輸入
-                        medicine_name = user_states.get(user_id, {}).get('medicine')
-                        if not medicine_name:
-                            reply_text = "請輸入要查詢的藥品名稱:"
-                        else:
-                            medicine_name = medicine_name.strip().lower()
-                            conn = sqlite3.connect(DB_PATH)
-                            cursor = conn.cursor()
-                            query = """
-                                SELECT DISTINCT 中文品名, 英文品名, 適應症
-                                FROM drugs
-                                WHERE LOWER(中文品名) = ? OR LOWER(英文品名) = ?
-                                LIMIT 1
-                            """
-                            cursor.execute(query, (medicine_name, medicine_name))
-                            row = cursor.fetchone()
-                            conn.close()
-                            print(f"[DEBUG] 查詢 drugs 結果：{row}")
-
-                            if row:
-                                zh_name, en_name, indication = row
-                                # 副作用由 AI 產生
-                                prompt = (
-                                    f"請只用簡短條列式（每點用-開頭，不要用*），僅列出副作用，"
-                                    f"針對藥品「{zh_name}」(英文名：{en_name})，"
-                                    "請用繁體中文回答，不要加任何說明、警語或強調語句。"
-                                )
-                                try:
-                                    ai_resp = chat.generate_content(prompt)
-                                    side_effects = ai_resp.text.strip()
-                                except Exception as e:
-                                    logging.exception("AI 產生副作用失敗")
-                                    side_effects = f"AI 回答失敗：{e}"
-                                reply_text = (
-                                    f"🔹 中文品名：{zh_name}\n"
-                                    f"📌 英文品名：{en_name}\n"
-                                    f"📄 適應症：{indication}\n"
-                                    f"⚠️ 副作用：\n{side_effects}"
-                                )
-                            else:
-                                reply_text = "未找到相關藥品，請重新輸入"
-                    except Exception as e:
-                        logging.exception("查詢資料時發生錯誤")
-                        reply_text = f"⚠️ 查詢資料時發生錯誤，請稍後再試"
-
-                    reply_request = ReplyMessageRequest(
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    return
+                elif field == "結束日期":
+                    state['step'] = 'edit_end_date'
+                    reply_request = CachedReplyMessageRequest(
                         reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text.strip())]
+                        messages=[EDIT_END_DATE_MESSAGE]
                     )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-
-                #圖片查詢
-                elif user_input == "圖片查詢":
-                    reply_text = "請傳送藥品圖片:"
-                    reply_request = ReplyMessageRequest(
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    return
+                elif field == "提醒時間":
+                    state['step'] = 'edit_times'
+                    reply_request = CachedReplyMessageRequest(
                         reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)]
+                        messages=[EDIT_TIMES_MESSAGE]
                     )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    return "OK"
-                
-                # 查詢藥局
-                elif "查詢藥局" in user_input:
-                    try:
-                        quick_reply = QuickReply(
-                            items=[QuickReplyItem(action=LocationAction(label="傳送我的位置"))]
-                        )
-                        reply_request = ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="請點選下方按鈕傳送你的位置，我才能幫你找附近藥局喔～", quick_reply=quick_reply)]
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    return
+                elif field.lower() == "完成":
+                    user_states.pop(user_id, None)
+                    reply_request = CachedReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[EDIT_DONE_MESSAGE]
+                    )
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    return
+                else:
+                    # 再次顯示選單
+                    reply_request = CachedReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[EDIT_FIELD_MENU_MESSAGE]
+                    )
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    return
+            elif state.get('step') == 'edit_times':
+                import re
+                times = [t.strip() for t in user_input.split(",") if t.strip()]
+                valid = all(re.match(r"^(?:[01]\d|2[0-3]):[0-5]\d$", t) for t in times)
+                if not times or not valid:
+                    reply_request = CachedReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[INVALID_TIMES_MESSAGE]
+                    )
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    return
+                await asyncio.to_thread(update_reminder, state['reminder_id'], "times", json.dumps(times))
+                reply_text = "提醒時間已更新！"
+                # 修改完繼續顯示選單
+                reply_text += "\n請選擇要繼續修改的欄位，或輸入 完成 結束："
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text, quick_reply=EDIT_FIELD_QUICK_REPLY)]
+                )
+                await messaging_api.reply_message(reply_message_request=reply_request)
+                state['step'] = 'edit_field'
+                return
+
+        # ====== 其他功能區塊（查詢藥品、AI、藥局、圖片） ======
+        user_input = event.message.text.strip()
+        print("[DEBUG] 進入原有功能區塊，收到訊息：", user_input)
+
+        # AI 問答
+        if user_input.startswith("AI "):
+            with ai_admission.admit(user_id) as admitted:
+                if not admitted:
+                    reply_request = CachedReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[BUSY_MESSAGE]
+                    )
+                    await messaging_api.reply_message(reply_message_request=reply_request)
+                    return
+                prompt = "你是一個中文的AI助手，請用繁體中文回答。\n" + user_input[3:].strip()
+                try:
+                    response = await chat.generate_content_async(prompt)
+                    reply_text = response.text
+                except Exception as e:
+                    logging.exception("AI 問答發生錯誤")
+                    reply_text = "⚠️ AI 回答失敗，請稍後再試"
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text.strip())]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            return
+
+        # 查詢藥品
+        elif user_input == "查詢藥品":
+            try:
+                # 這裡應該要有 medicine_name 的來源，通常是 user_states 或請用戶再輸入
+                medicine_name = user_states.get(user_id, {}).get('medicine')
+                if not medicine_name:
+                    reply_text = "請輸入要查詢的藥品名稱:"
+                else:
+                    medicine_name = medicine_name.strip().lower()
+                    row = await asyncio.to_thread(find_drug, medicine_name, exact=True)
+                    print(f"[DEBUG] 查詢 drugs 結果：{row}")
+
+                    if row:
+                        zh_name, en_name, indication = row
+                        # 副作用優先使用預先產生的結果，沒有才由 AI 產生
+                        try:
+                            side_effects = await lookup_side_effects(user_id, zh_name, en_name)
+                        except Exception as e:
+                            logging.exception("AI 產生副作用失敗")
+                            side_effects = f"AI 回答失敗：{e}"
+                        reply_text = (
+                            f"🔹 中文品名：{zh_name}\n"
+                            f"📌 英文品名：{en_name}\n"
+                            f"📄 適應症：{indication}\n"
+                            f"⚠️ 副作用：\n{side_effects}"
                         )
-                        messaging_api.reply_message(reply_message_request=reply_request)
+                    else:
+                        reply_text = "未找到相關藥品，請重新輸入"
+            except Exception as e:
+                logging.exception("查詢資料時發生錯誤")
+                reply_text = f"⚠️ 查詢資料時發生錯誤，請稍後再試"
+
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text.strip())]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+
+        #圖片查詢
+        elif user_input == "圖片查詢":
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[ASK_IMAGE_MESSAGE]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            return
+        
+        # 查詢藥局
+        elif "查詢藥局" in user_input:
+            try:
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[ASK_LOCATION_MESSAGE]
+                )
+                await messaging_api.reply_message(reply_message_request=reply_request)
+            except Exception as e:
+                logging.exception("查詢藥局發生錯誤")
+                reply_text = "⚠️ 查詢藥局失敗，請稍後再試"
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text)]
+                )
+                await messaging_api.reply_message(reply_message_request=reply_request)
+                return
+        else:
+            quick_reply = None
+            try:
+                medicine_name = user_input
+                row = await asyncio.to_thread(find_drug, medicine_name)
+                print(f"[DEBUG] 查詢 drugs 結果：{row}")
+
+                if row:
+                    zh_name, en_name, indication = row
+                    # 副作用優先使用預先產生的結果，沒有才由 AI 產生
+                    try:
+                        side_effects = await lookup_side_effects(user_id, zh_name, en_name)
                     except Exception as e:
-                        logging.exception("查詢藥局發生錯誤")
-                        reply_text = "⚠️ 查詢藥局失敗，請稍後再試"
-                        reply_request = ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)]
-                        )
-                        messaging_api.reply_message(reply_message_request=reply_request)
-                        return "OK"
+                        side_effects = f"AI 回答失敗：{e}"
+                    reply_text = (
+                        f"🔹 中文品名：{zh_name}\n"
+                        f"📌 英文品名：{en_name}\n"
+                        f"📄 適應症：{indication}\n"
+                        f"⚠️ 副作用：\n{side_effects}"
+                    )
+                elif (candidates := await asyncio.to_thread(drug_matcher.match, medicine_name)):
+                    # 錯字、全半形或空白造成的查無資料，大多可在本地找到候選，不必呼叫 AI
+                    print(f"[DEBUG] 藥名容錯比對候選：{candidates}")
+                    reply_text = f"找不到「{medicine_name}」，你要查詢的是以下藥品嗎？"
+                    quick_reply = drug_suggestion_quick_reply(candidates)
                 else:
-                    try:
-                        medicine_name = user_input
-                        conn = sqlite3.connect(DB_PATH)
-                        cursor = conn.cursor()
-                        query = """
-                        SELECT DISTINCT 中文品名, 英文品名, 適應症
-                        FROM drugs
-                        WHERE 中文品名 LIKE ? OR 英文品名 LIKE ?
-                        LIMIT 1
-                        """
-                        like_param = f'%{medicine_name}%'
-                        cursor.execute(query, (like_param, like_param))
-                        row = cursor.fetchone()
-                        conn.close()
-                        print(f"[DEBUG] 查詢 drugs 結果：{row}")
-
-                        if row:
-                            zh_name, en_name, indication = row
-                            # 副作用由 AI 產生
-                            prompt = (
-                                f"請只用簡短條列式（每點用-開頭，不要用*），僅列出副作用，"
-                                f"針對藥品「{zh_name}」(英文名：{en_name})，"
-                                "請用繁體中文回答，不要加任何說明、警語或強調語句。"
-                            )
-                            try:
-                                ai_resp = chat.generate_content(prompt)
-                                side_effects = ai_resp.text.strip()
-                            except Exception as e:
-                                side_effects = f"AI 回答失敗：{e}"
-                            reply_text = (
-                                f"🔹 中文品名：{zh_name}\n"
-                                f"📌 英文品名：{en_name}\n"
-                                f"📄 適應症：{indication}\n"
-                                f"⚠️ 副作用：\n{side_effects}"
-                            )
+                    prompt = (
+                        f"請用以下格式，幫我介紹藥品「{medicine_name}」，"
+                        "只要條列資料本身，不要加任何說明、警語或強調語句：\n"
+                        "🔹 中文品名：\n"
+                        "📌 英文品名：\n"
+                        "📄 適應症：\n"
+                        "⚠️ 副作用：\n（請用-開頭條列，不要用*）"
+                    )
+                    with ai_admission.admit(user_id) as admitted:
+                        if not admitted:
+                            reply_text = BUSY_TEXT
                         else:
-                            prompt = (
-                                f"請用以下格式，幫我介紹藥品「{medicine_name}」，"
-                                "只要條列資料本身，不要加任何說明、警語或強調語句：\n"
-                                "🔹 中文品名：\n"
-                                "📌 英文品名：\n"
-                                "📄 適應症：\n"
-                                "⚠️ 副作用：\n（請用-開頭條列，不要用*）"
-                            )
                             try:
-                                ai_resp = chat.generate_content(prompt)
+                                ai_resp = await chat.generate_content_async(prompt)
                                 reply_text = ai_resp.text
                             except Exception as e:
                                 reply_text = f"AI 回答失敗：{e}"
 
-                    except Exception as e:
-                        reply_text = f"⚠️ 查詢資料時發生錯誤：{str(e)}"
-
-                    reply_request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text.strip())]
-                    )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-
-            elif event.type == "message" and event.message.type == "location":
-                print("[DEBUG] 收到位置訊息")
-                user_lat = event.message.latitude
-                user_lng = event.message.longitude
-
-                nearby_url = (
-                    f"https://maps.googleapis.com/maps/api/place/nearbysearch/json?"
-                    f"location={user_lat},{user_lng}&radius=1000&type=pharmacy&language=zh-TW&key={GOOGLE_MAP_API_KEY}"
+            except Exception as e:
+                reply_text = f"⚠️ 查詢資料時發生錯誤：{str(e)}"
+
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text.strip(), quick_reply=quick_reply)]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+
+    elif event.type == "message" and event.message.type == "location":
+        print("[DEBUG] 收到位置訊息")
+        user_lat = event.message.latitude
+        user_lng = event.message.longitude
+
+        nearby_url = (
+            f"https://maps.googleapis.com/maps/api/place/nearbysearch/json?"
+            f"location={user_lat},{user_lng}&radius=1000&type=pharmacy&language=zh-TW&key={GOOGLE_MAP_API_KEY}"
+        )
+        nearby_res = await io_core.get_json(nearby_url)
+        print(f"[DEBUG] nearby_res: {nearby_res}")
+
+        if not nearby_res.get('results'):
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[NO_PHARMACY_MESSAGE]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            return
+
+        # 各藥局的電話與距離查詢同時送出
+        bubbles = await asyncio.gather(*(
+            fetch_pharmacy_bubble(place, user_lat, user_lng) for place in nearby_res['results'][:3]
+        ))
+
+        flex_message = carousel_message("附近藥局推薦", bubbles)
+
+        reply_request = CachedReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[flex_message]
+        )
+        await messaging_api.reply_message(reply_message_request=reply_request)
+        return
+    elif event.type == "message" and event.message.type == "image":
+        print("[DEBUG] 收到圖片訊息")
+        user_id = event.source.user_id
+        # 先檢查准入再下載圖片，被拒絕時不浪費頻寬
+        with ai_admission.admit(user_id) as admitted:
+            if not admitted:
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[BUSY_MESSAGE]
+                )
+                await messaging_api.reply_message(reply_message_request=reply_request)
+                return
+            try:
+                content = await blob_api.get_message_content(message_id=event.message.id)
+                image = await asyncio.to_thread(save_image, content)
+
+                prompt = (
+                    "請根據這張圖片判斷藥品資訊，若圖片無法判斷適應症或副作用，請根據藥品名稱推測並補充，"
+                    "只要條列資料本身，不要加任何說明、警語或強調語句，也不要加**：\n"
+                    "🔹 中文品名：\n"
+                    "📌 英文品名：\n"
+                    "📄 適應症：\n"
+                    "⚠️ 副作用：\n（請用-開頭條列，不要用*）"
                 )
-                nearby_res = requests.get(nearby_url).json()
-                print(f"[DEBUG] nearby_res: {nearby_res}")
-
-                if not nearby_res.get('results'):
-                    reply_request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="附近找不到藥局")]
-                    )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    return "OK"
-
-                bubbles = []
-                for place in nearby_res['results'][:3]:
-                    place_id = place['place_id']
-                    name = place.get('name', '藥局名稱未知')
-                    address = place.get('vicinity', '地址不詳')
-                    location = place['geometry']['location']
-                    dest_lat, dest_lng = location['lat'], location['lng']
-
-                    # 取得電話
-                    details_url = (
-                        f"https://maps.googleapis.com/maps/api/place/details/json?"
-                        f"place_id={place_id}&fields=name,formatted_phone_number&key={GOOGLE_MAP_API_KEY}"
-                    )
-                    details_res = requests.get(details_url).json()
-                    phone = details_res.get('result', {}).get('formatted_phone_number', '電話不詳')
-
-                    # 取得距離
-                    dist_url = (
-                        f"https://maps.googleapis.com/maps/api/distancematrix/json?"
-                        f"origins={user_lat},{user_lng}&destinations={dest_lat},{dest_lng}&key={GOOGLE_MAP_API_KEY}"
-                    )
-                    dist_res = requests.get(dist_url).json()
-                    distance = dist_res['rows'][0]['elements'][0]['distance']['text']
-
-                    map_url = f"https://www.google.com/maps/search/?api=1&query={dest_lat},{dest_lng}"
-
-                    bubble = FlexBubble(
-                        body=FlexBox(
-                            layout="vertical",
-                            contents=[
-                                FlexText(text=name, weight="bold", size="lg"),
-                                FlexText(text=f"地址：{address}", size="sm", color="#555555", wrap=True),
-                                FlexText(text=f"電話：{phone}", size="sm", color="#555555"),
-                                FlexText(text=f"距離：{distance}", size="sm", color="#777777"),
-                            ],
-                        ),
-                        footer=FlexBox(
-                            layout="vertical",
-                            contents=[
-                                FlexButton(
-                                    style="link",
-                                    height="sm",
-                                    action=URIAction(label="地圖導航", uri=map_url),
-                                )
-                            ],
-                        ),
-                    )
-                    bubbles.append(bubble)
 
-                from linebot.v3.messaging.models import FlexCarousel, FlexMessage
+                response = await chat.generate_content_async([image, prompt])
+                description = response.text
 
-                carousel = FlexCarousel(contents=bubbles)
-                flex_message = FlexMessage(
-                    alt_text="附近藥局推薦",
-                    contents=carousel
+                reply_request = CachedReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=description.strip())]
                 )
-
-                reply_request = ReplyMessageRequest(
+                await messaging_api.reply_message(reply_message_request=reply_request)
+            except Exception as e:
+                logging.exception("圖片處理發生錯誤")
+                reply_text = "⚠️ 圖片處理失敗，請稍後再試"
+                reply_request = CachedReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[flex_message]
+                    messages=[TextMessage(text=reply_text)]
                 )
-                messaging_api.reply_message(reply_message_request=reply_request)
-                return "OK"
-            elif event.type == "message" and event.message.type == "image":
-                print("[DEBUG] 收到圖片訊息")
-                try:
-                    content = blob_api.get_message_content(message_id=event.message.id)
-                    with tempfile.NamedTemporaryFile(dir=static_tmp_path, suffix=".jpg", delete=False) as tf:
-                        tf.write(content)
-                        filename = os.path.basename(tf.name)
-                    image = Image.open(tf.name)
+                await messaging_api.reply_message(reply_message_request=reply_request)
+                return
+
+    elif event.type == "postback":
+        user_id = event.source.user_id
+        data = event.postback.data
+        print(f"[DEBUG] postback data: {data}, user_states: {user_states.get(user_id)}")
+        # 用藥提醒步驟分開訊息
+        if data == "start_date":
+            user_states[user_id]['start_date'] = event.postback.params['date']
+            user_states[user_id]['step'] = 'ask_end'
+            # 先回覆
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=f"你選擇的開始日期為：{event.postback.params['date']}")]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            # 再推送下一步
+            await messaging_api.push_message(
+                push_message_request=CachedPushMessageRequest(
+                    to=user_id,
+                    messages=[ASK_END_DATE_MESSAGE]
+                )
+            )
+            return
+        elif data == "end_date":
+            user_states[user_id]['end_date'] = event.postback.params['date']
+            user_states[user_id]['step'] = 'ask_times'
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=f"你選擇的結束日期為：{event.postback.params['date']}")]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            await messaging_api.push_message(
+                push_message_request=CachedPushMessageRequest(
+                    to=user_id,
+                    messages=[ASK_TIMES_MESSAGE]
+                )
+            )
+            return
+        # 修改用藥提醒步驟分開訊息
+        elif data == "edit_start_date":
+            user_states[user_id]['step'] = 'edit_field'
+            new_start = event.postback.params['date']
+            await asyncio.to_thread(update_reminder, user_states[user_id]['reminder_id'], "start_date", new_start)
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=f"開始日期已更新為：{new_start}")]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            await messaging_api.push_message(
+                push_message_request=CachedPushMessageRequest(
+                    to=user_id,
+                    messages=[EDIT_FIELD_CONTINUE_MESSAGE]
+                )
+            )
+            return
+        elif data == "edit_end_date":
+            user_states[user_id]['step'] = 'edit_field'
+            new_end = event.postback.params['date']
+            await asyncio.to_thread(update_reminder, user_states[user_id]['reminder_id'], "end_date", new_end)
+            reply_request = CachedReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=f"結束日期已更新為：{new_end}")]
+            )
+            await messaging_api.reply_message(reply_message_request=reply_request)
+            await messaging_api.push_message(
+                push_message_request=CachedPushMessageRequest(
+                    to=user_id,
+                    messages=[EDIT_FIELD_CONTINUE_MESSAGE]
+                )
+            )
+            return
 
-                    prompt = (
-                        "請根據這張圖片判斷藥品資訊，若圖片無法判斷適應症或副作用，請根據藥品名稱推測並補充，"
-                        "只要條列資料本身，不要加任何說明、警語或強調語句，也不要加**：\n"
-                        "🔹 中文品名：\n"
-                        "📌 英文品名：\n"
-                        "📄 適應症：\n"
-                        "⚠️ 副作用：\n（請用-開頭條列，不要用*）"
-                    )
+@app.route("/callback", methods=["POST"])
+def callback():
+    signature = request.headers.get("X-Line-Signature", "")
+    body = request.get_data(as_text=True)
+    print(f"[DEBUG] 收到 callback 請求，body={body}")
 
-                    response = chat.generate_content([image, prompt])
-                    description = response.text
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        print("[DEBUG] InvalidSignatureError")
+        abort(400)
+    except Exception as e:
+        print("[DEBUG] Webhook parse error:", e)
+        abort(400)
 
-                    reply_request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=description.strip())]
-                    )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                except Exception as e:
-                    logging.exception("圖片處理發生錯誤")
-                    reply_text = "⚠️ 圖片處理失敗，請稍後再試"
-                    reply_request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)]
-                    )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    return "OK"
-
-            elif event.type == "postback":
-                user_id = event.source.user_id
-                data = event.postback.data
-                print(f"[DEBUG] postback data: {data}, user_states: {user_states.get(user_id)}")
-                # 用藥提醒步驟分開訊息
-                if data == "start_date":
-                    user_states[user_id]['start_date'] = event.postback.params['date']
-                    user_states[user_id]['step'] = 'ask_end'
-                    # 先回覆
-                    reply_request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=f"你選擇的開始日期為：{event.postback.params['date']}")]
-                    )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    # 再推送下一步
-                    quick_reply = QuickReply(
-                        items=[
-                            QuickReplyItem(
-                                action=DatetimePickerAction(
-                                    label="選擇結束日期",
-                                    data="end_date",
-                                    mode="date"
-                                )
-                            )
-                        ]
-                    )
-                    messaging_api.push_message(
-                        push_message_request=PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="請選擇提醒結束日期：", quick_reply=quick_reply)]
-                        )
-                    )
-                    return "OK"
-                elif data == "end_date":
-                    user_states[user_id]['end_date'] = event.postback.params['date']
-                    user_states[user_id]['step'] = 'ask_times'
-                    reply_request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=f"你選擇的結束日期為：{event.postback.params['date']}")]
-                    )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    messaging_api.push_message(
-                        push_message_request=PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="請輸入每天要提醒的時間（24小時制，可多個，用逗號分隔，如 08:00,12:00,18:00）：")]
-                        )
-                    )
-                    return "OK"
-                # 修改用藥提醒步驟分開訊息
-                elif data == "edit_start_date":
-                    user_states[user_id]['step'] = 'edit_field'
-                    new_start = event.postback.params['date']
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute("UPDATE reminders SET start_date=? WHERE id=?", (new_start, user_states[user_id]['reminder_id']))
-                    conn.commit()
-                    conn.close()
-                    reply_request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=f"開始日期已更新為：{new_start}")]
-                    )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    quick_reply = QuickReply(
-                        items=[
-                            QuickReplyItem(action=MessageAction(label="開始日期", text="開始日期")),
-                            QuickReplyItem(action=MessageAction(label="結束日期", text="結束日期")),
-                            QuickReplyItem(action=MessageAction(label="提醒時間", text="提醒時間")),
-                            QuickReplyItem(action=MessageAction(label="完成", text="完成")),
-                        ]
-                    )
-                    messaging_api.push_message(
-                        push_message_request=PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="請選擇要繼續修改的欄位，或輸入 完成 結束：", quick_reply=quick_reply)]
-                        )
-                    )
-                    return "OK"
-                elif data == "edit_end_date":
-                    user_states[user_id]['step'] = 'edit_field'
-                    new_end = event.postback.params['date']
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute("UPDATE reminders SET end_date=? WHERE id=?", (new_end, user_states[user_id]['reminder_id']))
-                    conn.commit()
-                    conn.close()
-                    reply_request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=f"結束日期已更新為：{new_end}")]
-                    )
-                    messaging_api.reply_message(reply_message_request=reply_request)
-                    quick_reply = QuickReply(
-                        items=[
-                            QuickReplyItem(action=MessageAction(label="開始日期", text="開始日期")),
-                            QuickReplyItem(action=MessageAction(label="結束日期", text="結束日期")),
-                            QuickReplyItem(action=MessageAction(label="提醒時間", text="提醒時間")),
-                            QuickReplyItem(action=MessageAction(label="完成", text="完成")),
-                        ]
-                    )
-                    messaging_api.push_message(
-                        push_message_request=PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="請選擇要繼續修改的欄位，或輸入 完成 結束：", quick_reply=quick_reply)]
-                        )
-                    )
-                    return "OK"
+    # 事件交給事件迴圈處理，webhook 立即回應，不佔用 worker 等待 LINE/Gemini/Maps
+    io_core.spawn(handle_events(events))
 
     print("[DEBUG] callback 執行結束")
     return "OK"
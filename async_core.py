@@ -0,0 +1,85 @@
+"""對外 I/O 的 asyncio 核心。
+
+LINE Messaging API、Google Maps 與 Gemini 的呼叫都在同一個背景事件迴圈上執行，
+等待回應時不佔用執行緒，一個行程就能同時處理大量進行中的對話。
+Flask 與 APScheduler 的執行緒透過 submit()/run() 把協程交給事件迴圈。
+"""
+import asyncio
+import logging
+import threading
+
+import aiohttp
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, AsyncMessagingApiBlob
+
+
+class AsyncIOCore:
+    def __init__(self, configuration, max_connections=100, http_timeout=10):
+        self.configuration = configuration
+        self.max_connections = max_connections
+        self.http_timeout = http_timeout
+        self.loop = None
+        self.api_client = None
+        self.messaging_api = None
+        self.blob_api = None
+        self.http = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # 第一次使用時才啟動，避免 gunicorn 之類先 import 再 fork 的情況把事件迴圈留在父行程
+        with self._lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-io-core", daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+            self.loop = loop
+
+    async def _setup(self):
+        # aiohttp 的 session 必須在事件迴圈內建立
+        self.configuration.connection_pool_maxsize = self.max_connections
+        self.api_client = AsyncApiClient(self.configuration)
+        self.messaging_api = AsyncMessagingApi(self.api_client)
+        self.blob_api = AsyncMessagingApiBlob(self.api_client)
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=self.http_timeout),
+        )
+
+    async def _teardown(self):
+        await self.http.close()
+        await self.api_client.close()
+
+    def close(self):
+        with self._lock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._teardown(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+    def submit(self, coro):
+        """從其他執行緒排入協程，回傳 concurrent.futures.Future。"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def spawn(self, coro):
+        """排入不等待結果的協程，發生例外時寫入 log。"""
+        future = self.submit(coro)
+        future.add_done_callback(_log_exception)
+        return future
+
+    def run(self, coro, timeout=None):
+        """從其他執行緒執行協程並等待結果。"""
+        return self.submit(coro).result(timeout)
+
+    async def push(self, push_message_request):
+        return await self.messaging_api.push_message(push_message_request=push_message_request)
+
+    async def get_json(self, url):
+        async with self.http.get(url) as resp:
+            return await resp.json(content_type=None)
+
+
+def _log_exception(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("事件迴圈工作發生錯誤", exc_info=future.exception())
@@ -0,0 +1,135 @@
+"""比較 threaded 與 asyncio 兩種對外 I/O 路徑在大量同時對話下的完成時間。
+
+本機啟動一個固定延遲的假上游（模擬 LINE／Gemini／Maps），每個「對話」依序呼叫三次，
+並像事件處理一樣讀寫一次 sqlite（查 reminders、寫一筆並 commit）。asyncio 路徑另外量測
+直接在事件迴圈上做 sqlite 的版本，用來對照 asyncio.to_thread 的效果：
+
+    python bench_async_core.py --conversations 300 --latency 0.2 --workers 8
+"""
+import os
+import time
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from aiohttp import web
+from linebot.v3.messaging import Configuration
+
+from async_core import AsyncIOCore
+
+CALLS_PER_CONVERSATION = 3
+
+
+def start_fake_upstream(latency, port):
+    async def handle(request):
+        await asyncio.sleep(latency)
+        return web.json_response({"ok": True})
+
+    async def serve():
+        server = web.Application()
+        server.router.add_get("/", handle)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port, backlog=1024).start()
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(serve(), loop).result()
+
+
+def init_bench_db(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE reminders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, medicine TEXT)")
+    conn.executemany(
+        "INSERT INTO reminders (user_id, medicine) VALUES (?, ?)",
+        ((f"U{i % 1000}", f"藥品{i}") for i in range(10000))
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_work(db_path, n):
+    # 與 handle_event 的查詢／寫入相同：每次開一條連線，查一次、寫一次
+    conn = sqlite3.connect(db_path, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT medicine FROM reminders WHERE user_id=?", (f"U{n % 1000}",))
+    cursor.fetchall()
+    cursor.execute("INSERT INTO reminders (user_id, medicine) VALUES (?, ?)", (f"U{n % 1000}", "bench"))
+    conn.commit()
+    conn.close()
+
+
+def bench_threaded(url, db_path, conversations, workers):
+    local = threading.local()
+
+    def conversation(n):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        for _ in range(CALLS_PER_CONVERSATION):
+            session.get(url).json()
+        db_work(db_path, n)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(conversation, range(conversations)))
+    return time.perf_counter() - started
+
+
+def bench_async(url, db_path, conversations, max_connections, db_off_loop=True):
+    core = AsyncIOCore(Configuration(access_token="bench"), max_connections=max_connections)
+
+    async def conversation(n):
+        for _ in range(CALLS_PER_CONVERSATION):
+            await core.get_json(url)
+        if db_off_loop:
+            await asyncio.to_thread(db_work, db_path, n)
+        else:
+            db_work(db_path, n)
+
+    async def all_conversations():
+        await asyncio.gather(*(conversation(n) for n in range(conversations)))
+
+    core.start()
+    started = time.perf_counter()
+    core.run(all_conversations())
+    elapsed = time.perf_counter() - started
+    core.close()
+    return elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="threaded 與 asyncio I/O 路徑基準測試")
+    arg_parser.add_argument("--conversations", type=int, default=300)
+    arg_parser.add_argument("--latency", type=float, default=0.2, help="假上游每次回應的延遲秒數")
+    arg_parser.add_argument("--workers", type=int, default=8, help="threaded 路徑的 worker 數")
+    arg_parser.add_argument("--max-connections", type=int, default=100, help="asyncio 路徑的連線池大小")
+    arg_parser.add_argument("--port", type=int, default=18765)
+    args = arg_parser.parse_args()
+
+    start_fake_upstream(args.latency, args.port)
+    url = f"http://127.0.0.1:{args.port}/"
+    ideal = args.latency * CALLS_PER_CONVERSATION
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.db")
+        init_bench_db(db_path)
+        for name, elapsed in (
+            (f"threaded ({args.workers} workers)",
+             bench_threaded(url, db_path, args.conversations, args.workers)),
+            (f"asyncio ({args.max_connections} conn, to_thread)",
+             bench_async(url, db_path, args.conversations, args.max_connections)),
+            (f"asyncio ({args.max_connections} conn, DB on loop)",
+             bench_async(url, db_path, args.conversations, args.max_connections, db_off_loop=False)),
+        ):
+            print(f"{name:<36}{elapsed:>8.2f} s  {args.conversations / elapsed:>8.1f} 對話/s"
+                  f"  （單一對話至少 {ideal:.2f} s）")
+
+
+if __name__ == "__main__":
+    main()
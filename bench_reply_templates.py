@@ -0,0 +1,91 @@
+"""比較每次回覆都重建模型與使用 reply_templates 預先建立樣板的建構＋序列化成本。
+
+    python bench_reply_templates.py
+"""
+import timeit
+
+from linebot.v3.messaging import ApiClient, Configuration
+from linebot.v3.messaging.models import (
+    TextMessage, ReplyMessageRequest, QuickReply, QuickReplyItem, MessageAction,
+    FlexMessage, FlexCarousel, FlexBubble, FlexBox, FlexText, FlexButton, URIAction
+)
+
+from reply_templates import (
+    CachedReplyMessageRequest, EDIT_FIELD_MENU_MESSAGE, pharmacy_bubble, carousel_message
+)
+
+api_client = ApiClient(Configuration(access_token="bench"))
+serialize = api_client.sanitize_for_serialization
+
+PHARMACIES = [
+    (f"藥局{i}", f"台北市中正區某路{i}號", "02-1234-5678", f"{i * 100} 公尺",
+     f"https://www.google.com/maps/search/?api=1&query=25.0{i},121.5{i}")
+    for i in range(3)
+]
+
+
+def edit_menu_rebuilt():
+    quick_reply = QuickReply(
+        items=[
+            QuickReplyItem(action=MessageAction(label="開始日期", text="開始日期")),
+            QuickReplyItem(action=MessageAction(label="結束日期", text="結束日期")),
+            QuickReplyItem(action=MessageAction(label="提醒時間", text="提醒時間")),
+            QuickReplyItem(action=MessageAction(label="完成", text="完成")),
+        ]
+    )
+    reply_request = ReplyMessageRequest(
+        reply_token="token",
+        messages=[TextMessage(text="請選擇要修改的欄位，或輸入 完成 結束：", quick_reply=quick_reply)]
+    )
+    return serialize(reply_request)
+
+
+def edit_menu_template():
+    reply_request = CachedReplyMessageRequest(reply_token="token", messages=[EDIT_FIELD_MENU_MESSAGE])
+    return serialize(reply_request)
+
+
+def carousel_rebuilt():
+    bubbles = []
+    for name, address, phone, distance, map_url in PHARMACIES:
+        bubbles.append(FlexBubble(
+            body=FlexBox(
+                layout="vertical",
+                contents=[
+                    FlexText(text=name, weight="bold", size="lg"),
+                    FlexText(text=f"地址：{address}", size="sm", color="#555555", wrap=True),
+                    FlexText(text=f"電話：{phone}", size="sm", color="#555555"),
+                    FlexText(text=f"距離：{distance}", size="sm", color="#777777"),
+                ],
+            ),
+            footer=FlexBox(
+                layout="vertical",
+                contents=[FlexButton(style="link", height="sm", action=URIAction(label="地圖導航", uri=map_url))],
+            ),
+        ))
+    flex_message = FlexMessage(alt_text="附近藥局推薦", contents=FlexCarousel(contents=bubbles))
+    return serialize(ReplyMessageRequest(reply_token="token", messages=[flex_message]))
+
+
+def carousel_template():
+    bubbles = [pharmacy_bubble(*pharmacy) for pharmacy in PHARMACIES]
+    flex_message = carousel_message("附近藥局推薦", bubbles)
+    return serialize(CachedReplyMessageRequest(reply_token="token", messages=[flex_message]))
+
+
+def bench(name, func, number=2000):
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<28}{best * 1e6:>10.1f} µs/回覆")
+    return best
+
+
+if __name__ == "__main__":
+    assert edit_menu_rebuilt() == edit_menu_template()
+    assert carousel_rebuilt() == carousel_template()
+
+    rebuilt = bench("修改選單（每次重建）", edit_menu_rebuilt)
+    template = bench("修改選單（樣板）", edit_menu_template)
+    print(f"{'':<28}{rebuilt / template:>10.1f}x")
+    rebuilt = bench("藥局輪播（每次重建）", carousel_rebuilt, number=500)
+    template = bench("藥局輪播（樣板）", carousel_template, number=500)
+    print(f"{'':<28}{rebuilt / template:>10.1f}x")
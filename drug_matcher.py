@@ -0,0 +1,209 @@
+"""容錯的藥名比對：啟動時由 drugs 資料表建立記憶體內的 n-gram 索引。
+
+查詢與藥名都先經過 NFKC（全形轉半形）、大小寫折疊並去除空白與標點，
+再以 bigram 找出候選，最後用有上限的編輯距離（與藥名任一子字串比較）排序。
+drugs 資料表的異動由 trigger 記錄在 drugs_changes，refresh() 只重新載入有變動的列。
+"""
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return "".join(ch for ch in text if ch.isalnum())
+
+
+def bigrams(key):
+    padded = f"^{key}$"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+def max_distance_for(query):
+    if len(query) <= 2:
+        return 0
+    if len(query) <= 4:
+        return 1
+    if len(query) <= 8:
+        return 2
+    return 3
+
+
+def substring_distance(query, text, max_distance):
+    # query 與 text 任一子字串的最小編輯距離（text 前後多出的字不計），超過上限回傳 None。
+    # 用 Myers 的 bit-parallel 演算法，把動態規劃的一整欄放在一個整數裡，每個 text 字元只做幾次位元運算
+    if not query:
+        return 0
+    peq = {}
+    for i, ch in enumerate(query):
+        peq[ch] = peq.get(ch, 0) | (1 << i)
+    mask = (1 << len(query)) - 1
+    last = 1 << (len(query) - 1)
+    pv, mv = mask, 0
+    score = best = len(query)
+    for ch in text:
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+            if score < best:
+                best = score
+        # 子字串比對：第 0 列全為 0，左移時不補 1
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return best if best <= max_distance else None
+
+
+def init_drug_change_log(db_path):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS drugs_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        drug_rowid INTEGER NOT NULL
+    );
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS drugs_changes_insert AFTER INSERT ON drugs BEGIN
+        INSERT INTO drugs_changes (drug_rowid) VALUES (new.rowid);
+    END;
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS drugs_changes_update AFTER UPDATE ON drugs BEGIN
+        INSERT INTO drugs_changes (drug_rowid) VALUES (old.rowid);
+        INSERT INTO drugs_changes (drug_rowid) VALUES (new.rowid);
+    END;
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS drugs_changes_delete AFTER DELETE ON drugs BEGIN
+        INSERT INTO drugs_changes (drug_rowid) VALUES (old.rowid);
+    END;
+    """)
+    conn.commit()
+    conn.close()
+
+
+class DrugMatcher:
+    # 很常見的 bigram（如「錠」「mg」）對縮小候選沒有幫助，超過全部藥品一定比例的 posting list 一律略過；
+    # 另外限制每次查詢累計計數的 rowid 總數，查詢成本就不會隨資料表成長
+    MAX_POSTING_SHARE = 0.1
+    POSTING_BUDGET = 8000
+    MAX_CANDIDATES = 30
+
+    def __init__(self):
+        self.entries = {}
+        self.postings = {}
+        self.last_seq = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, rowid, zh_name, en_name):
+        keys = tuple(key for key in (normalize(zh_name), normalize(en_name)) if key)
+        if not keys:
+            return
+        self.remove(rowid)
+        self.entries[rowid] = (zh_name, en_name, keys)
+        for key in keys:
+            for gram in bigrams(key):
+                self.postings.setdefault(gram, set()).add(rowid)
+
+    def remove(self, rowid):
+        entry = self.entries.pop(rowid, None)
+        if entry is None:
+            return
+        for key in entry[2]:
+            for gram in bigrams(key):
+                posting = self.postings.get(gram)
+                if posting is not None:
+                    posting.discard(rowid)
+                    if not posting:
+                        del self.postings[gram]
+
+    def load(self, db_path):
+        # 先在新的物件建好再換進來，建立期間仍可查詢舊索引
+        fresh = DrugMatcher()
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT IFNULL(MAX(seq), 0) FROM drugs_changes")
+        fresh.last_seq = cursor.fetchone()[0]
+        cursor.execute("SELECT rowid, 中文品名, 英文品名 FROM drugs")
+        for rowid, zh_name, en_name in cursor:
+            fresh.add(rowid, zh_name, en_name)
+        conn.close()
+        with self.lock:
+            self.entries, self.postings, self.last_seq = fresh.entries, fresh.postings, fresh.last_seq
+        print(f"[DEBUG] 藥名比對索引建立完成，共 {len(fresh.entries)} 筆")
+
+    def refresh(self, db_path):
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT seq, drug_rowid FROM drugs_changes WHERE seq > ? ORDER BY seq", (self.last_seq,))
+        changes = cursor.fetchall()
+        if not changes:
+            conn.close()
+            return
+        rowids = {rowid for _, rowid in changes}
+        placeholders = ",".join("?" * len(rowids))
+        cursor.execute(f"SELECT rowid, 中文品名, 英文品名 FROM drugs WHERE rowid IN ({placeholders})", tuple(rowids))
+        rows = cursor.fetchall()
+        last_seq = changes[-1][0]
+        # 單一行程執行，套用後的異動紀錄就不再需要
+        cursor.execute("DELETE FROM drugs_changes WHERE seq <= ?", (last_seq,))
+        conn.commit()
+        conn.close()
+        with self.lock:
+            for rowid in rowids:
+                self.remove(rowid)
+            for rowid, zh_name, en_name in rows:
+                self.add(rowid, zh_name, en_name)
+            self.last_seq = last_seq
+        print(f"[DEBUG] 藥名比對索引更新 {len(rowids)} 筆")
+
+    def match(self, query, limit=5):
+        """回傳最接近的藥品 [(中文品名, 英文品名), ...]，依相似度排序並去除重複名稱。"""
+        query = normalize(query)
+        if not query:
+            return []
+        max_distance = max_distance_for(query)
+        with self.lock:
+            posting_lists = sorted(
+                (self.postings[gram] for gram in bigrams(query) if gram in self.postings), key=len
+            )
+            # 小資料表的 posting list 本來就短，至少允許 MAX_CANDIDATES 筆
+            max_posting = max(self.MAX_CANDIDATES, int(len(self.entries) * self.MAX_POSTING_SHARE))
+            budget = self.POSTING_BUDGET
+            overlap = Counter()
+            # 由短到長，遇到第一個太長或超出預算的就停止，後面只會更長
+            for posting in posting_lists:
+                if len(posting) > max_posting or len(posting) > budget:
+                    break
+                overlap.update(posting)
+                budget -= len(posting)
+            scored = []
+            for rowid, shared in overlap.most_common(self.MAX_CANDIDATES):
+                zh_name, en_name, keys = self.entries[rowid]
+                distances = [d for d in (substring_distance(query, key, max_distance) for key in keys) if d is not None]
+                if distances:
+                    scored.append((min(distances), -shared, min(len(key) for key in keys), zh_name, en_name))
+        scored.sort(key=lambda item: item[:3])
+        results = []
+        seen = set()
+        for _, _, _, zh_name, en_name in scored:
+            name = zh_name or en_name
+            if name in seen:
+                continue
+            seen.add(name)
+            results.append((zh_name, en_name))
+            if len(results) >= limit:
+                break
+        return results
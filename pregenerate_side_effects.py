@@ -0,0 +1,145 @@
+"""離線批次預先產生 drugs 資料表每筆藥品的副作用文字。
+
+可隨時中斷（Ctrl+C），下次執行會從 side_effects_checkpoint 記錄的位置繼續：
+
+    python pregenerate_side_effects.py --concurrency 4 --rate 2
+"""
+import os
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import google.generativeai as genai
+
+from side_effects import (
+    SIDE_EFFECTS_PROMPT_VERSION, init_side_effects_table, save_side_effects, generate_side_effects
+)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "linebot.db")
+
+
+class RateLimiter:
+    # 讓所有 worker 共用同一個發送間隔，避免超過 Gemini 的每秒請求上限
+    def __init__(self, rate_per_sec):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_for = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+def load_checkpoint(cursor):
+    cursor.execute("SELECT last_rowid FROM side_effects_checkpoint WHERE prompt_version=?", (SIDE_EFFECTS_PROMPT_VERSION,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def save_checkpoint(cursor, last_rowid):
+    cursor.execute(
+        "INSERT OR REPLACE INTO side_effects_checkpoint (prompt_version, last_rowid) VALUES (?, ?)",
+        (SIDE_EFFECTS_PROMPT_VERSION, last_rowid)
+    )
+
+
+def run(chat, concurrency=4, rate=2.0, batch_size=50, retries=2, reset=False):
+    init_side_effects_table(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    cursor = conn.cursor()
+    if reset:
+        save_checkpoint(cursor, 0)
+        conn.commit()
+    last_rowid = load_checkpoint(cursor)
+    print(f"[INFO] prompt 版本 {SIDE_EFFECTS_PROMPT_VERSION}，從 rowid > {last_rowid} 繼續")
+
+    limiter = RateLimiter(rate)
+
+    def worker(zh_name, en_name):
+        for attempt in range(retries + 1):
+            limiter.wait()
+            try:
+                return generate_side_effects(chat, zh_name, en_name)
+            except Exception:
+                logging.exception(f"產生副作用失敗（第 {attempt + 1} 次）：{zh_name}")
+        return None
+
+    done = failed = 0
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        while True:
+            # 已有同版本結果的藥品直接略過，所以 --reset 重跑時只會補齊缺漏
+            cursor.execute("""
+                SELECT d.rowid, d.中文品名, d.英文品名
+                FROM drugs d
+                LEFT JOIN drug_side_effects s
+                  ON s.中文品名 = IFNULL(d.中文品名, '') AND s.英文品名 = IFNULL(d.英文品名, '')
+                 AND s.prompt_version = ?
+                WHERE d.rowid > ? AND s.side_effects IS NULL
+                ORDER BY d.rowid
+                LIMIT ?
+            """, (SIDE_EFFECTS_PROMPT_VERSION, last_rowid, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            futures = [(zh_name, en_name, executor.submit(worker, zh_name, en_name)) for _, zh_name, en_name in rows]
+            # 等整批 Gemini 回應都收齊後才開始寫入，等待期間不持有資料庫寫入鎖，
+            # 與機器人同時執行時不會擋住排程寫入 reminders_log
+            results = []
+            for zh_name, en_name, future in futures:
+                side_effects = future.result()
+                if side_effects is None:
+                    failed += 1
+                    continue
+                results.append((zh_name, en_name, side_effects))
+
+            # 結果與檢查點在同一個短交易寫入，中斷後最多只重做目前這一批
+            # 同一個藥名在 drugs 可能出現多次，寫入時以主鍵去重
+            last_rowid = rows[-1][0]
+            for zh_name, en_name, side_effects in results:
+                save_side_effects(cursor, zh_name, en_name, side_effects)
+            save_checkpoint(cursor, last_rowid)
+            conn.commit()
+            done += len(results)
+            print(f"[INFO] 進度 rowid={last_rowid}，完成 {done} 筆，失敗 {failed} 筆")
+    finally:
+        # 中斷時取消還沒開始的請求，未提交的這一批下次會重做
+        executor.shutdown(wait=True, cancel_futures=True)
+        conn.close()
+
+    print(f"[INFO] 批次結束，完成 {done} 筆，失敗 {failed} 筆（失敗的藥品可用 --reset 重跑補齊）")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="預先產生藥品副作用文字")
+    arg_parser.add_argument("--concurrency", type=int, default=4, help="同時呼叫 Gemini 的數量")
+    arg_parser.add_argument("--rate", type=float, default=2.0, help="每秒最多送出的請求數")
+    arg_parser.add_argument("--batch-size", type=int, default=50, help="每次寫入檢查點的筆數")
+    arg_parser.add_argument("--retries", type=int, default=2, help="單筆失敗的重試次數")
+    arg_parser.add_argument("--reset", action="store_true", help="忽略檢查點，從頭補齊缺漏的藥品")
+    args = arg_parser.parse_args()
+
+    google_api_key = os.environ.get("GOOGLE_API_KEY")
+    if not google_api_key:
+        raise RuntimeError("Missing essential environment variables")
+    genai.configure(api_key=google_api_key)
+    chat = genai.GenerativeModel(model_name="gemini-1.5-flash")
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        run(chat, args.concurrency, args.rate, args.batch_size, args.retries, args.reset)
+    except KeyboardInterrupt:
+        print("[INFO] 已中斷，下次執行會從檢查點繼續")
+
+
+if __name__ == "__main__":
+    main()
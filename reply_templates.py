@@ -0,0 +1,151 @@
+"""回覆訊息樣板：靜態選單在啟動時建立一次並快取序列化結果。
+
+SDK 送出請求前會把 pydantic 模型轉成 dict（to_dict），選單每次重建再序列化都是重複工作。
+這裡的 Prebuilt* 類別只在第一次 to_dict() 時計算並保留結果，模型複製（SDK 驗證參數時會複製）
+也會帶著快取；動態的藥局輪播則直接由精簡的 dict 樣板填值，不再建立整棵 Flex 模型。
+"""
+from pydantic.v1 import PrivateAttr
+
+from linebot.v3.messaging.models import (
+    TextMessage, ReplyMessageRequest, PushMessageRequest, FlexMessage,
+    QuickReply, QuickReplyItem, LocationAction, DatetimePickerAction, MessageAction
+)
+
+
+def _prebuilt(model_cls):
+    class Prebuilt(model_cls):
+        _serialized = PrivateAttr(default=None)
+
+        def to_dict(self):
+            if self._serialized is None:
+                self._serialized = super().to_dict()
+            return self._serialized
+
+    Prebuilt.__name__ = Prebuilt.__qualname__ = f"Prebuilt{model_cls.__name__}"
+    return Prebuilt
+
+
+PrebuiltQuickReply = _prebuilt(QuickReply)
+PrebuiltTextMessage = _prebuilt(TextMessage)
+PrebuiltFlexMessage = _prebuilt(FlexMessage)
+
+
+def _request_without_message_dump(request_cls):
+    # 原本的 to_dict 會先用 pydantic 的 dict() 把 messages 整個走過一次，再用各訊息的 to_dict() 覆蓋，
+    # 這裡略過第一次，讓快取的訊息不會再被重新展開
+    class Cached(request_cls):
+        def to_dict(self):
+            _dict = self.dict(by_alias=True, exclude={'messages'}, exclude_none=True)
+            _dict['messages'] = [item.to_dict() for item in self.messages if item]
+            return _dict
+
+    Cached.__name__ = Cached.__qualname__ = f"Cached{request_cls.__name__}"
+    return Cached
+
+
+CachedReplyMessageRequest = _request_without_message_dump(ReplyMessageRequest)
+CachedPushMessageRequest = _request_without_message_dump(PushMessageRequest)
+
+
+def _static(model):
+    # 啟動時就先序列化一次
+    model.to_dict()
+    return model
+
+
+def static_text(text, quick_reply=None):
+    return _static(PrebuiltTextMessage(text=text, quick_reply=quick_reply))
+
+
+def date_picker_quick_reply(label, data):
+    return _static(PrebuiltQuickReply(
+        items=[QuickReplyItem(action=DatetimePickerAction(label=label, data=data, mode="date"))]
+    ))
+
+
+# ====== 靜態快速回覆 ======
+EDIT_FIELD_QUICK_REPLY = _static(PrebuiltQuickReply(
+    items=[
+        QuickReplyItem(action=MessageAction(label="開始日期", text="開始日期")),
+        QuickReplyItem(action=MessageAction(label="結束日期", text="結束日期")),
+        QuickReplyItem(action=MessageAction(label="提醒時間", text="提醒時間")),
+        QuickReplyItem(action=MessageAction(label="完成", text="完成")),
+    ]
+))
+START_DATE_QUICK_REPLY = date_picker_quick_reply("選擇開始日期", "start_date")
+END_DATE_QUICK_REPLY = date_picker_quick_reply("選擇結束日期", "end_date")
+EDIT_START_DATE_QUICK_REPLY = date_picker_quick_reply("選擇開始日期", "edit_start_date")
+EDIT_END_DATE_QUICK_REPLY = date_picker_quick_reply("選擇結束日期", "edit_end_date")
+LOCATION_QUICK_REPLY = _static(PrebuiltQuickReply(
+    items=[QuickReplyItem(action=LocationAction(label="傳送我的位置"))]
+))
+
+# ====== 靜態訊息 ======
+ASK_MEDICINE_MESSAGE = static_text("請輸入要提醒的藥品名稱：")
+ASK_START_DATE_MESSAGE = static_text("請選擇提醒開始日期：", START_DATE_QUICK_REPLY)
+ASK_END_DATE_MESSAGE = static_text("請選擇提醒結束日期：", END_DATE_QUICK_REPLY)
+ASK_TIMES_MESSAGE = static_text("請輸入每天要提醒的時間（24小時制，可多個，用逗號分隔，如 08:00,12:00,18:00）：")
+INVALID_TIMES_MESSAGE = static_text("時間格式錯誤，請重新輸入（24小時制，如 08:00,12:00,18:00）：")
+NO_REMINDERS_MESSAGE = static_text("你還沒有設定過任何藥物提醒。")
+REMINDER_NOT_FOUND_MESSAGE = static_text("查無此藥品提醒資料。")
+EDIT_START_DATE_MESSAGE = static_text("請選擇新的開始日期：", EDIT_START_DATE_QUICK_REPLY)
+EDIT_END_DATE_MESSAGE = static_text("請選擇新的結束日期：", EDIT_END_DATE_QUICK_REPLY)
+EDIT_TIMES_MESSAGE = static_text("請輸入新的提醒時間（24小時制，用逗號分隔）：")
+EDIT_DONE_MESSAGE = static_text("已結束修改。")
+EDIT_FIELD_MENU_MESSAGE = static_text("請選擇要修改的欄位，或輸入 完成 結束：", EDIT_FIELD_QUICK_REPLY)
+EDIT_FIELD_CONTINUE_MESSAGE = static_text("請選擇要繼續修改的欄位，或輸入 完成 結束：", EDIT_FIELD_QUICK_REPLY)
+ASK_IMAGE_MESSAGE = static_text("請傳送藥品圖片:")
+ASK_LOCATION_MESSAGE = static_text("請點選下方按鈕傳送你的位置，我才能幫你找附近藥局喔～", LOCATION_QUICK_REPLY)
+NO_PHARMACY_MESSAGE = static_text("附近找不到藥局")
+BUSY_TEXT = "⚠️ 目前查詢人數較多，請稍後再試"
+BUSY_MESSAGE = static_text(BUSY_TEXT)
+
+
+# ====== 動態快速回覆 ======
+def drug_suggestion_quick_reply(candidates):
+    # 按鈕標籤最多 20 字，送出的文字用完整藥名，點選後直接命中資料庫查詢
+    items = []
+    for zh_name, en_name in candidates:
+        name = zh_name or en_name
+        items.append(QuickReplyItem(action=MessageAction(label=name[:20], text=name)))
+    return QuickReply(items=items)
+
+
+# ====== 動態藥局輪播 ======
+def pharmacy_bubble(name, address, phone, distance, map_url):
+    return {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {"type": "text", "text": name, "weight": "bold", "size": "lg"},
+                {"type": "text", "text": f"地址：{address}", "size": "sm", "color": "#555555", "wrap": True},
+                {"type": "text", "text": f"電話：{phone}", "size": "sm", "color": "#555555"},
+                {"type": "text", "text": f"距離：{distance}", "size": "sm", "color": "#777777"},
+            ],
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "button",
+                    "style": "link",
+                    "height": "sm",
+                    "action": {"type": "uri", "label": "地圖導航", "uri": map_url},
+                }
+            ],
+        },
+    }
+
+
+def carousel_message(alt_text, bubbles):
+    # 樣板已經是 LINE 的 JSON 格式，直接當作序列化結果，略過 Flex 模型的建立與驗證
+    message = PrebuiltFlexMessage.construct(type="flex", alt_text=alt_text)
+    message._serialized = {
+        "type": "flex",
+        "altText": alt_text,
+        "contents": {"type": "carousel", "contents": bubbles},
+    }
+    return message
@@ -0,0 +1,82 @@
+import asyncio
+import sqlite3
+import datetime
+
+# 修改 prompt 內容時請一併調整版本號，舊版本的預先產生結果就不會再被使用
+SIDE_EFFECTS_PROMPT_VERSION = "v1"
+
+
+def build_side_effects_prompt(zh_name, en_name):
+    return (
+        f"請只用簡短條列式（每點用-開頭，不要用*），僅列出副作用，"
+        f"針對藥品「{zh_name}」(英文名：{en_name})，"
+        "請用繁體中文回答，不要加任何說明、警語或強調語句。"
+    )
+
+
+def init_side_effects_table(db_path):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS drug_side_effects (
+        中文品名 TEXT NOT NULL,
+        英文品名 TEXT NOT NULL,
+        prompt_version TEXT NOT NULL,
+        side_effects TEXT NOT NULL,
+        generated_at TEXT NOT NULL,
+        PRIMARY KEY (中文品名, 英文品名, prompt_version)
+    );
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS side_effects_checkpoint (
+        prompt_version TEXT PRIMARY KEY,
+        last_rowid INTEGER NOT NULL
+    );
+    """)
+    conn.commit()
+    conn.close()
+
+
+def get_cached_side_effects(db_path, zh_name, en_name, prompt_version=SIDE_EFFECTS_PROMPT_VERSION):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT side_effects FROM drug_side_effects WHERE 中文品名=? AND 英文品名=? AND prompt_version=?",
+        (zh_name or "", en_name or "", prompt_version)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def save_side_effects(cursor, zh_name, en_name, side_effects, prompt_version=SIDE_EFFECTS_PROMPT_VERSION):
+    cursor.execute(
+        "INSERT OR REPLACE INTO drug_side_effects (中文品名, 英文品名, prompt_version, side_effects, generated_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (zh_name or "", en_name or "", prompt_version, side_effects,
+         datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"))
+    )
+
+
+def generate_side_effects(chat, zh_name, en_name):
+    ai_resp = chat.generate_content(build_side_effects_prompt(zh_name, en_name))
+    return ai_resp.text.strip()
+
+
+async def generate_side_effects_async(chat, zh_name, en_name):
+    ai_resp = await chat.generate_content_async(build_side_effects_prompt(zh_name, en_name))
+    return ai_resp.text.strip()
+
+
+def _store_side_effects(db_path, zh_name, en_name, side_effects):
+    conn = sqlite3.connect(db_path)
+    save_side_effects(conn.cursor(), zh_name, en_name, side_effects)
+    conn.commit()
+    conn.close()
+
+
+async def generate_and_store_side_effects_async(db_path, chat, zh_name, en_name):
+    # 即時產生的結果也寫回，下次查詢就不用再等
+    side_effects = await generate_side_effects_async(chat, zh_name, en_name)
+    await asyncio.to_thread(_store_side_effects, db_path, zh_name, en_name, side_effects)
+    return side_effects